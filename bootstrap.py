@@ -0,0 +1,23 @@
+import os
+import sys  # For printing to stderr
+from dotenv import load_dotenv
+
+# Imported first by models.py and server.py so the .env file is loaded exactly once
+
+# --- DIAGNOSTIC PRINT 1 ---
+if os.getenv('DEBUG_DB') == '1':
+    print(
+        f"[DEBUG PRE-DOTENV] os.environ.get('SUPABASE_PORT'): '{os.environ.get('SUPABASE_PORT')}'",
+        file=sys.stderr
+    )
+# --- END DIAGNOSTIC PRINT 1 ---
+
+load_dotenv()  # Load .env file for local development
+
+# --- DIAGNOSTIC PRINT 2 ---
+if os.getenv('DEBUG_DB') == '1':
+    print(
+        f"[DEBUG POST-DOTENV] os.environ.get('SUPABASE_PORT'): '{os.environ.get('SUPABASE_PORT')}'",
+        file=sys.stderr
+    )
+# --- END DIAGNOSTIC PRINT 2 ---
@@ -0,0 +1,44 @@
+import fcntl
+import os
+import threading
+
+# gthread workers: the app's rate limiter, caches and death flusher are thread based,
+# and psycopg2 calls would block a gevent worker's event loop without extra patching.
+bind = f"0.0.0.0:{os.environ.get('FLASK_RUN_PORT', 5001)}"
+workers = int(os.environ.get('GUNICORN_WORKERS', 4))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+SCHEDULER_LOCK_FILE = os.environ.get('SCHEDULER_LOCK_FILE', '/tmp/arid_dread_scheduler.lock')
+
+
+def on_starting(server):
+    from models import create_db_and_tables, engine
+    create_db_and_tables()
+    # Close the master's pooled connection so forked workers don't inherit and share it
+    engine.dispose()
+
+
+def post_worker_init(worker):
+    import server as dread_server
+
+    # Every worker buffers its own deaths, so every worker needs a flusher
+    threading.Thread(target=dread_server.run_death_flusher, daemon=True).start()
+    threading.Thread(target=run_scheduler_when_elected, args=(dread_server,), daemon=True).start()
+
+
+def worker_exit(server, worker):
+    import server as dread_server
+
+    # Write out deaths this worker acknowledged but hadn't flushed yet
+    dread_server.flush_pending_deaths()
+
+
+def run_scheduler_when_elected(dread_server):
+    # Only the worker holding the lock runs the periodic tasks. The OS releases the lock
+    # when that worker exits, letting a waiting worker take over.
+    lock_file = open(SCHEDULER_LOCK_FILE, 'w')
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    dread_server.run_periodic_tasks()
+    # Keep this thread (and with it the open lock file) alive for the life of the worker
+    threading.Event().wait()
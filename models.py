@@ -1,27 +1,14 @@
+import bootstrap  # noqa: F401  Loads .env before any configuration is read
 from datetime import datetime
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, UniqueConstraint
+from sqlalchemy import create_engine, event, Column, Integer, String, Float, DateTime, UniqueConstraint, Index
 from sqlalchemy.engine import URL  # Import URL for robust connection string creation
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 import os
 import sys  # For printing to stderr
-from dotenv import load_dotenv
 
-# --- DIAGNOSTIC PRINT 1 ---
-print(
-    f"[DEBUG PRE-DOTENV] os.environ.get('SUPABASE_PORT'): '{os.environ.get('SUPABASE_PORT')}'",
-    file=sys.stderr
-)
-# --- END DIAGNOSTIC PRINT 1 ---
-
-load_dotenv()  # Load .env file for local development
-
-# --- DIAGNOSTIC PRINT 2 ---
-print(
-    f"[DEBUG POST-DOTENV] os.environ.get('SUPABASE_PORT'): '{os.environ.get('SUPABASE_PORT')}'",
-    file=sys.stderr
-)
-# --- END DIAGNOSTIC PRINT 2 ---
+# SQLite file used for local development and as the fallback; overridable so tests can use a temp DB
+SQLITE_DATABASE_URL = f"sqlite:///{os.environ.get('SQLITE_DB_PATH', 'dread_system.db')}"
 
 # Determine database connection type
 DB_CONNECTION_TYPE = os.environ.get('DB_CONNECTION_TYPE', 'SQLITE').upper()
@@ -34,10 +21,11 @@ if DB_CONNECTION_TYPE == 'SUPABASE':
     SUPABASE_DB_NAME = os.environ.get('SUPABASE_DB_NAME', 'postgres')
 
     # --- DIAGNOSTIC PRINT 3 ---
-    print(
-        f"[DEBUG IN-SUPABASE-IF] SUPABASE_PORT variable value: '{SUPABASE_PORT}'",
-        file=sys.stderr
-    )
+    if os.getenv('DEBUG_DB') == '1':
+        print(
+            f"[DEBUG IN-SUPABASE-IF] SUPABASE_PORT variable value: '{SUPABASE_PORT}'",
+            file=sys.stderr
+        )
     # --- END DIAGNOSTIC PRINT 3 ---
 
     if not all([SUPABASE_HOST, SUPABASE_RAW_PASSWORD]):
@@ -46,7 +34,7 @@ if DB_CONNECTION_TYPE == 'SUPABASE':
             "SUPABASE_PASSWORD is not set. Falling back to SQLite.",
             file=sys.stderr
         )
-        DATABASE_URL_STR = 'sqlite:///dread_system.db'
+        DATABASE_URL_STR = SQLITE_DATABASE_URL
     else:
         try:
             db_url_obj = URL.create(
@@ -72,18 +60,73 @@ if DB_CONNECTION_TYPE == 'SUPABASE':
                 "CRITICAL WARNING: Falling back to SQLite due to SUPABASE_PORT conversion error.",
                 file=sys.stderr
             )
-            DATABASE_URL_STR = 'sqlite:///dread_system.db'
+            DATABASE_URL_STR = SQLITE_DATABASE_URL
 elif DB_CONNECTION_TYPE == 'SQLITE':
-    DATABASE_URL_STR = 'sqlite:///dread_system.db'
+    DATABASE_URL_STR = SQLITE_DATABASE_URL
     print(f"[INFO] Using SQLite database: {DATABASE_URL_STR}", file=sys.stderr)
 else:
     print(
         f"CRITICAL WARNING: Unknown DB_CONNECTION_TYPE '{DB_CONNECTION_TYPE}'. Falling back to SQLite.",
         file=sys.stderr
     )
-    DATABASE_URL_STR = 'sqlite:///dread_system.db'
+    DATABASE_URL_STR = SQLITE_DATABASE_URL
+
+# Connection pool sizing, per process: request threads plus the death flusher and scheduler
+# share this pool. The defaults cover one gunicorn worker (8 threads + 2 background threads).
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '8'))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', '2'))
+
+if DATABASE_URL_STR.startswith('sqlite'):
+    # SQLite connections are handed between Flask threads and the scheduler thread
+    engine = create_engine(
+        DATABASE_URL_STR,
+        connect_args={"check_same_thread": False},
+        pool_pre_ping=True,
+        query_cache_size=1200,
+    )
+else:
+    engine = create_engine(
+        DATABASE_URL_STR,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_pre_ping=True,
+        pool_recycle=1800,
+        pool_use_lifo=True,
+        query_cache_size=1200,
+        # Batch executemany() INSERT/UPDATEs instead of sending one statement per row
+        executemany_mode='values_plus_batch',
+        insertmanyvalues_page_size=1000,
+        executemany_batch_page_size=500,
+    )
+
+if engine.dialect.name == 'sqlite':
+    SQLITE_PRAGMAS = (
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA mmap_size=268435456",
+        "PRAGMA cache_size=-64000",
+        "PRAGMA busy_timeout=5000",
+    )
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_conn, connection_record):
+        # Disable pysqlite's implicit transactions; begin_sqlite_transaction emits BEGIN instead
+        dbapi_conn.isolation_level = None
+        cursor = dbapi_conn.cursor()
+        for pragma in SQLITE_PRAGMAS:
+            cursor.execute(pragma)
+        cursor.close()
+
+    @event.listens_for(engine, "begin")
+    def begin_sqlite_transaction(conn):
+        # Write transactions take the write lock up front, so a read-then-write
+        # transaction waits on busy_timeout instead of failing with SQLITE_BUSY
+        if conn.get_execution_options().get('sqlite_immediate'):
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+        else:
+            conn.exec_driver_sql("BEGIN")
 
-engine = create_engine(DATABASE_URL_STR)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
@@ -97,6 +140,11 @@ class AreaDeathCount(Base):
     death_count = Column(Float, default=0)
     last_updated = Column(DateTime, default=datetime.utcnow)
 
+    # Lets the top-N dread calculation read areas in death_count order without a full sort
+    __table_args__ = (
+        Index('ix_area_death_counts_death_count', death_count.desc()),
+    )
+
 
 class DreadLevel(Base):
     __tablename__ = 'dread_levels'
@@ -106,19 +154,29 @@ class DreadLevel(Base):
     level = Column(Integer, default=0)
     last_updated = Column(DateTime, default=datetime.utcnow)
 
+    # Partial index: get_elevated_dread_areas only ever reads rows with level > 0
+    __table_args__ = (
+        Index(
+            'ix_dread_levels_level_positive', level,
+            postgresql_where=level > 0, sqlite_where=level > 0
+        ),
+    )
+
 
 class PlayerNote(Base):
     __tablename__ = 'player_notes'
 
     id = Column(Integer, primary_key=True, index=True)
-    area_id = Column(String(100), nullable=False, index=True)
+    area_id = Column(String(100), nullable=False)
     note_location_id = Column(String(100), nullable=False)
     word = Column(String(50), nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
 
     # Composite unique constraint for area_id and note_location_id
+    # Covering index so note lookups by area_id are index-only scans on PostgreSQL
     __table_args__ = (
         UniqueConstraint('area_id', 'note_location_id', name='uq_player_note_location', sqlite_on_conflict='REPLACE'),
+        Index('ix_player_notes_area_covering', area_id, postgresql_include=['note_location_id', 'word']),
     )
 
 
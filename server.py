@@ -1,49 +1,91 @@
-from flask import Flask, request, jsonify
+import bootstrap  # noqa: F401  Loads .env before any configuration is read
+from flask import Flask, Response, g, request
 from flask_cors import CORS
 import time
 import threading
 from datetime import datetime
-from models import SessionLocal, AreaDeathCount, DreadLevel, PlayerNote, create_db_and_tables
+from models import SessionLocal, AreaDeathCount, DreadLevel, PlayerNote, create_db_and_tables, engine
+from sqlalchemy import bindparam, lambda_stmt, select, update, delete, func
 from sqlalchemy.orm import Session
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import DataError, DisconnectionError, IntegrityError, InterfaceError, OperationalError
 import contextlib
+import hashlib
+import hmac
+from collections import Counter, OrderedDict, deque
 from functools import wraps 
 import os
 import json
-from dotenv import load_dotenv 
-
-load_dotenv()
+import logging
+import queue
+import sys
+import atexit
+from logging.handlers import QueueHandler, QueueListener
+import orjson
+from werkzeug.exceptions import HTTPException
+from apscheduler.schedulers.background import BackgroundScheduler
+
+# --- LOGGING ---
+# Handlers run on a QueueListener thread so request threads only enqueue records
+logger = logging.getLogger("dread")
+logger.setLevel(logging.INFO)
+# Records go out through our own queue handler only; propagating would print them twice under gunicorn/root handlers
+logger.propagate = False
+log_queue = queue.SimpleQueue()
+log_handler = logging.StreamHandler(sys.stdout)
+# Timestamps are formatted by the handler only for records that are actually emitted
+log_handler.setFormatter(
+    logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+)
+log_listener = QueueListener(log_queue, log_handler)
+logger.addHandler(QueueHandler(log_queue))
+log_listener.start()
+atexit.register(log_listener.stop)
 
 app = Flask(__name__)
 CORS(app)
 
+
+def json_response(obj, status=200):
+    return Response(orjson.dumps(obj), status=status, mimetype='application/json')
+
+
+@app.errorhandler(HTTPException)
+def handle_http_exception(e):
+    return json_response({"error": e.description}, e.code)
+
+
 # --- API Key Authentication ---
 VALID_API_KEYS_JSON = os.environ.get('VALID_API_KEYS_JSON')
 VALID_API_KEYS = {}
 
-print(f"[DEBUG] Initial VALID_API_KEYS_JSON from env: '{'present' if VALID_API_KEYS_JSON else 'not present'}'")
+logger.debug("Initial VALID_API_KEYS_JSON from env: %s", 'present' if VALID_API_KEYS_JSON else 'not present')
 
 if VALID_API_KEYS_JSON:
     try:
         VALID_API_KEYS = json.loads(VALID_API_KEYS_JSON)
         if not isinstance(VALID_API_KEYS, dict):
-            print(
-                "Error: VALID_API_KEYS_JSON in .env did not parse into a dictionary. "
+            logger.error(
+                "VALID_API_KEYS_JSON in .env did not parse into a dictionary. "
                 "API key auth might not work as expected."
             )
             VALID_API_KEYS = {} 
     except json.JSONDecodeError:
-        print(
-            "Error: VALID_API_KEYS_JSON in .env is not valid JSON. "
+        logger.error(
+            "VALID_API_KEYS_JSON in .env is not valid JSON. "
             "API key auth might not work as expected."
         )
         VALID_API_KEYS = {} 
 
-print(f"[DEBUG] Parsed VALID_API_KEYS: {{len(VALID_API_KEYS)}} keys loaded.")
+logger.debug("Parsed VALID_API_KEYS: %d keys loaded.", len(VALID_API_KEYS))
+
+# Keys pre-encoded once for constant-time comparison in match_api_key
+VALID_API_KEY_ITEMS = tuple((str(key).encode(), client_name) for key, client_name in VALID_API_KEYS.items())
 
 if not VALID_API_KEYS:
-    print(
-        "CRITICAL WARNING: VALID_API_KEYS is not configured or is invalid. "
+    logger.critical(
+        "VALID_API_KEYS is not configured or is invalid. "
         "API key authentication will DENY ALL requests to protected routes."
     )  
     
@@ -56,39 +98,74 @@ def require_api_key(f):
         client_ip = request.remote_addr
         current_time = time.time()
 
-        if client_ip in request_attempts_by_ip:
-            request_attempts_by_ip[client_ip] = [
-                timestamp for timestamp in request_attempts_by_ip[client_ip]
-                if current_time - timestamp < RATE_LIMIT_WINDOW_SECONDS
-            ]
-        else:
-            request_attempts_by_ip[client_ip] = []
+        # Shard the per-IP state so concurrent requests only contend on the same shard's lock
+        lock, attempts_by_ip = request_attempts_shards[hash(client_ip) % RATE_LIMIT_SHARDS]
+        with lock:
+            attempts = attempts_by_ip.get(client_ip)
+            if attempts is None:
+                if len(attempts_by_ip) >= RATE_LIMIT_MAX_TRACKED_IPS // RATE_LIMIT_SHARDS:
+                    evict_idle_ips(attempts_by_ip, current_time)
+                attempts = attempts_by_ip[client_ip] = deque(maxlen=RATE_LIMIT_ATTEMPTS)
+
+            while attempts and current_time - attempts[0] >= RATE_LIMIT_WINDOW_SECONDS:
+                attempts.popleft()
 
-        if len(request_attempts_by_ip[client_ip]) >= RATE_LIMIT_ATTEMPTS:
-            print(f"Rate limit exceeded for IP: {client_ip}")
-            return jsonify({"error": "Too Many Requests - Rate limit exceeded"}), 429
+            rate_limited = len(attempts) >= RATE_LIMIT_ATTEMPTS
+            if not rate_limited and VALID_API_KEYS:
+                attempts.append(current_time)
+
+        if rate_limited:
+            logger.warning("Rate limit exceeded for IP: %s", client_ip)
+            return json_response({"error": "Too Many Requests - Rate limit exceeded"}, 429)
 
         # --- Original API Key Logic --- 
         if not VALID_API_KEYS:
-            print("API Key system not configured properly. Denying access.")
-            return jsonify({"error": "API Key system configuration error"}), 500
+            logger.error("API Key system not configured properly. Denying access.")
+            return json_response({"error": "API Key system configuration error"}, 500)
 
         api_key = request.headers.get('X-API-KEY')
-        request_attempts_by_ip[client_ip].append(current_time)
 
-        if api_key and api_key in VALID_API_KEYS:
+        client_name = match_api_key(api_key) if api_key else None
+        if client_name is not None:
+            g.client_name = client_name
             return f(*args, **kwargs)
         else:
-            print(f"Unauthorized API access attempt. Provided Key length: {len(api_key) if api_key else 0} for IP: {client_ip}")
-            return jsonify({"error": "Unauthorized - Invalid or missing API Key"}), 401
+            logger.warning("Unauthorized API access attempt for IP: %s", client_ip)
+            return json_response({"error": "Unauthorized - Invalid or missing API Key"}, 401)
     return decorated_function
 
+
+def match_api_key(api_key):
+    # Compare against every key with compare_digest so response timing doesn't reveal
+    # how much of a key matched; returns the client name for a valid key, else None
+    presented = api_key.encode()
+    matched_client = None
+    for key, client_name in VALID_API_KEY_ITEMS:
+        if hmac.compare_digest(presented, key):
+            matched_client = client_name
+    return matched_client
+
+
+def evict_idle_ips(attempts_by_ip, current_time):
+    # Drop IPs with no attempts left inside the window so scanners can't grow the dict forever.
+    # Caller must hold the shard's lock.
+    idle_ips = [
+        ip for ip, attempts in attempts_by_ip.items()
+        if not attempts or current_time - attempts[-1] >= RATE_LIMIT_WINDOW_SECONDS
+    ]
+    for ip in idle_ips:
+        del attempts_by_ip[ip]
+
+
 # --- DATABASE SETUP ---
 
 @contextlib.contextmanager
-def get_db():
+def get_db(write=False):
     db = SessionLocal()
     try:
+        if write:
+            # On SQLite this begins the transaction with BEGIN IMMEDIATE; ignored elsewhere
+            db.connection(execution_options={'sqlite_immediate': True})
         yield db
     except Exception:
         db.rollback()
@@ -97,6 +174,21 @@ def get_db():
         db.close()
 
 
+def dialect_insert(model):
+    # ON CONFLICT upserts are dialect-specific; pick the insert() matching the engine
+    if engine.dialect.name == 'postgresql':
+        return pg_insert(model)
+    return sqlite_insert(model)
+
+
+def utc_now():
+    # last_updated columns are naive UTC (datetime.utcnow defaults). PostgreSQL's now() is a timestamptz
+    # that would be shifted into the session time zone on assignment; SQLite's CURRENT_TIMESTAMP is UTC
+    if engine.dialect.name == 'postgresql':
+        return func.timezone('utc', func.now())
+    return func.now()
+
+
 # --- CONFIGURATION ---
 DEATH_COUNT_DECAY_FACTOR = 0.95
 DECAY_INTERVAL_SECONDS = 3600
@@ -106,161 +198,353 @@ MIN_DEATHS_FOR_DREAD = 1
 # --- RATE LIMITING CONFIGURATION ---
 RATE_LIMIT_ATTEMPTS = 10 
 RATE_LIMIT_WINDOW_SECONDS = 60 
-request_attempts_by_ip = {}
+RATE_LIMIT_MAX_TRACKED_IPS = 10000
+RATE_LIMIT_SHARDS = 16
+request_attempts_shards = [(threading.Lock(), {}) for _ in range(RATE_LIMIT_SHARDS)]
+
+
+# --- DEATH LOG BATCHING ---
+DEATH_FLUSH_INTERVAL_SECONDS = 0.25
+# Upper bound for the flusher's exponential backoff while the database is failing
+DEATH_FLUSH_MAX_BACKOFF_SECONDS = 30
+AREA_ID_MAX_LENGTH = AreaDeathCount.__table__.c.area_id.type.length
+# Stored per-area totals used to answer log_death; bounded LRU so arbitrary area ids can't grow
+# it forever, and expired so totals written by other workers (or decayed) are re-read
+DEATH_TOTALS_TTL_SECONDS = 60
+DEATH_TOTALS_MAX_ENTRIES = 10000
+pending_deaths = Counter()
+flushed_death_totals = OrderedDict()
+pending_deaths_lock = threading.Lock()
+
+
+def get_death_total(area_id):
+    # Caller must hold pending_deaths_lock
+    entry = flushed_death_totals.get(area_id)
+    if entry is None or time.monotonic() - entry[0] >= DEATH_TOTALS_TTL_SECONDS:
+        return None
+    flushed_death_totals.move_to_end(area_id)
+    return entry[1]
+
+
+def store_death_total(area_id, total):
+    # Caller must hold pending_deaths_lock
+    flushed_death_totals[area_id] = (time.monotonic(), total)
+    flushed_death_totals.move_to_end(area_id)
+    if len(flushed_death_totals) > DEATH_TOTALS_MAX_ENTRIES:
+        flushed_death_totals.popitem(last=False)
+
+
+def write_death_deltas(deltas):
+    # Timestamps come from the database (utc_now()) so no Python datetime is built per row
+    stmt = dialect_insert(AreaDeathCount).values([
+        {"area_id": area_id, "death_count": delta, "last_updated": utc_now()}
+        for area_id, delta in deltas.items()
+    ])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['area_id'],
+        set_={
+            'death_count': AreaDeathCount.__table__.c.death_count + stmt.excluded.death_count,
+            'last_updated': utc_now(),
+        },
+    ).returning(AreaDeathCount.area_id, AreaDeathCount.death_count)
+
+    with get_db(write=True) as db:
+        totals = db.execute(stmt).all()
+        db.commit()
+    return totals
+
+
+def is_connection_error(error):
+    # Transient failures where the database (or the connection to it) is unavailable
+    return isinstance(error, (OperationalError, InterfaceError, DisconnectionError)) or getattr(
+        error, 'connection_invalidated', False
+    )
+
+
+def requeue_deaths(deltas):
+    with pending_deaths_lock:
+        pending_deaths.update(deltas)
+
+
+def flush_pending_deaths():
+    # Returns False when deaths had to be re-queued, so the flusher loop can back off
+    with pending_deaths_lock:
+        if not pending_deaths:
+            return True
+        batch = dict(pending_deaths)
+        pending_deaths.clear()
+
+    failed = {}
+    try:
+        totals = write_death_deltas(batch)
+    except Exception as e:
+        if is_connection_error(e):
+            # Nothing can be written while the database is unreachable; keep it all queued
+            logger.error("Database unavailable, keeping %d pending deaths queued: %s", sum(batch.values()), e)
+            requeue_deaths(batch)
+            return False
+        totals = []
+        if len(batch) == 1:
+            area_id, delta = next(iter(batch.items()))
+            failed[area_id] = (delta, e)
+        else:
+            # Fall back to one write per area so a single failing area can't block the rest
+            logger.warning("Batched death flush failed, writing areas individually: %s", e)
+            for area_id, delta in batch.items():
+                try:
+                    totals.extend(write_death_deltas({area_id: delta}))
+                except Exception as area_error:
+                    failed[area_id] = (delta, area_error)
+
+    retry = {}
+    for area_id, (delta, error) in failed.items():
+        if isinstance(error, (DataError, IntegrityError)):
+            # The database rejected this area's data, so retrying can never succeed
+            logger.error("Dropping %d pending deaths for %s rejected by the database: %s", delta, area_id, error)
+        else:
+            logger.error("Error flushing %d pending deaths for %s, will retry: %s", delta, area_id, error)
+            retry[area_id] = delta
+    requeue_deaths(retry)
+
+    with pending_deaths_lock:
+        for area_id, total in totals:
+            store_death_total(area_id, total)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Flushed deaths for %d areas to database", len(totals))
+    return not retry
+
+
+def run_death_flusher():
+    delay = DEATH_FLUSH_INTERVAL_SECONDS
+    while True:
+        time.sleep(delay)
+        try:
+            flushed = flush_pending_deaths()
+        except Exception as e:
+            logger.exception("EXCEPTION in death flusher loop: %s. Attempting to continue...", e)
+            flushed = False
+        # Back off while flushes keep failing so an outage isn't retried four times a second
+        delay = DEATH_FLUSH_INTERVAL_SECONDS if flushed else min(delay * 2, DEATH_FLUSH_MAX_BACKOFF_SECONDS)
+
+
+# The flusher is a daemon thread, so write out any acknowledged deaths still pending on exit.
+# Registered after log_listener.stop so it runs first and its log lines are still emitted.
+atexit.register(flush_pending_deaths)
+
+
+# --- DREAD RESPONSE CACHE ---
+# Dread levels only change when calculate_and_assign_dread_levels runs, so GET responses
+# are cached as pre-serialized JSON until the next calculation (or the TTL) expires them.
+DREAD_CACHE_TTL_SECONDS = DREAD_CALCULATION_INTERVAL_SECONDS
+DREAD_CACHE_MAX_ENTRIES = 1000
+dread_cache = {}
+dread_version = 0
+dread_cache_lock = threading.Lock()
+
+
+def get_cached_dread(key):
+    with dread_cache_lock:
+        entry = dread_cache.get(key)
+    if entry and time.monotonic() - entry[0] < DREAD_CACHE_TTL_SECONDS:
+        return entry[1:]
+    return None
+
+
+def cache_dread(key, value, version):
+    body = orjson.dumps(value)
+    # Content-derived ETag so every gunicorn worker agrees on it, whichever one ran the calculation
+    etag = hashlib.blake2b(body, digest_size=8).hexdigest()
+    with dread_cache_lock:
+        # Skip the store if a dread calculation finished while the value was being read
+        if version == dread_version and (key in dread_cache or len(dread_cache) < DREAD_CACHE_MAX_ENTRIES):
+            dread_cache[key] = (time.monotonic(), value, body, etag)
+    return body, etag
+
+
+def dread_response(body, etag):
+    # Polling clients that send a matching If-None-Match get an empty 304 instead of the body
+    response = Response(body, status=200, mimetype='application/json')
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'max-age=5'
+    return response.make_conditional(request)
+
+
+def invalidate_dread_cache():
+    global dread_version
+    with dread_cache_lock:
+        dread_version += 1
+        dread_cache.clear()
 
 
 # --- DREAD CALCULATION LOGIC ---
 def calculate_and_assign_dread_levels():
-    with get_db() as db:
-        print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Calculating dread levels...")
+    with get_db(write=True) as db:
+        logger.info("Calculating dread levels...")
         try:
-            death_counts_query = db.query(AreaDeathCount).all()
-            if not death_counts_query:
-                print("No death data to process. Resetting all dread levels.")
-                db.query(DreadLevel).update({DreadLevel.level: 0})
-                db.commit()
-                return
+            top_areas = db.execute(
+                select(AreaDeathCount.area_id, AreaDeathCount.death_count)
+                .where(AreaDeathCount.death_count >= MIN_DEATHS_FOR_DREAD)
+                .order_by(AreaDeathCount.death_count.desc(), AreaDeathCount.id)
+                .limit(2)
+            ).all()
 
-            eligible_areas = [
-                (area.area_id, area.death_count)
-                for area in death_counts_query
-                if area.death_count >= MIN_DEATHS_FOR_DREAD
-            ]
+            db.execute(update(DreadLevel).values(level=0))
 
-            if not eligible_areas:
-                print("No areas eligible for dread levels. Resetting all dread levels.")
-                db.query(DreadLevel).update({DreadLevel.level: 0})
+            if not top_areas:
+                logger.info("No areas eligible for dread levels. Resetting all dread levels.")
                 db.commit()
+                invalidate_dread_cache()
                 return
 
-            sorted_areas_by_deaths = sorted(eligible_areas, key=lambda x: x[1], reverse=True)
-
-            db.query(DreadLevel).update({DreadLevel.level: 0})
-
-            if len(sorted_areas_by_deaths) > 0:
-                top_area_id, count = sorted_areas_by_deaths[0]
-                update_or_create_dread_level(db, top_area_id, 2)
-                print(f"  Assigning Dread Level 2 to: {top_area_id} (Deaths: {count})")
-
-            if len(sorted_areas_by_deaths) > 1:
-                second_area_id, count = sorted_areas_by_deaths[1]
-                update_or_create_dread_level(db, second_area_id, 1)
-                print(f"  Assigning Dread Level 1 to: {second_area_id} (Deaths: {count})")
+            for (area_id, count), level in zip(top_areas, (2, 1)):
+                upsert_dread_level(db, area_id, level)
+                logger.info("  Assigning Dread Level %d to: %s (Deaths: %s)", level, area_id, count)
 
             db.commit()
-            print("Dread levels updated in database")
+            invalidate_dread_cache()
+            logger.info("Dread levels updated in database")
         except IntegrityError as e:
-            print(f"Database integrity error during dread calculation: {e}")
+            logger.error("Database integrity error during dread calculation: %s", e)
             db.rollback()
         except Exception as e:
-            print(f"Error during dread calculation: {e}")
+            logger.error("Error during dread calculation: %s", e)
             db.rollback()
             raise
 
 
-def update_or_create_dread_level(db: Session, area_id: str, level: int):
-    dread_level = db.query(DreadLevel).filter_by(area_id=area_id).first()
-    if dread_level:
-        dread_level.level = level
-        dread_level.last_updated = datetime.utcnow()
-    else:
-        db.add(DreadLevel(area_id=area_id, level=level))
-
+def upsert_dread_level(db: Session, area_id: str, level: int):
+    stmt = dialect_insert(DreadLevel).values(area_id=area_id, level=level, last_updated=utc_now())
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=['area_id'],
+        set_={'level': level, 'last_updated': utc_now()},
+    ))
 
 
 def decay_death_counts():
-    with get_db() as db:
-        print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Applying decay to death counts...")
+    with get_db(write=True) as db:
+        logger.info("Applying decay to death counts...")
         try:
-            death_counts_query = db.query(AreaDeathCount).all()
-            if not death_counts_query:
-                print("No death counts to decay.")
+            decayed = db.execute(
+                update(AreaDeathCount).values(
+                    death_count=func.round(AreaDeathCount.death_count * DEATH_COUNT_DECAY_FACTOR),
+                    last_updated=utc_now(),
+                )
+            )
+            if not decayed.rowcount:
+                logger.info("No death counts to decay.")
                 return
 
-            for death_count_obj in death_counts_query:
-                death_count_obj.death_count = round(death_count_obj.death_count * DEATH_COUNT_DECAY_FACTOR)
-                if death_count_obj.death_count < 1:
-                    db.delete(death_count_obj)
-                    print(f"  Removed {death_count_obj.area_id} from death_counts due to low count after decay.")
-                else:
-                    death_count_obj.last_updated = datetime.utcnow()
+            removed = db.execute(delete(AreaDeathCount).where(AreaDeathCount.death_count < 1))
+            logger.info(
+                "  Decayed %d areas, removed %d due to low count after decay.", decayed.rowcount, removed.rowcount
+            )
 
             db.commit()
-            print("Death counts decayed in database")
+            # Cached totals predate the decay (and may name deleted areas); re-read them on next use
+            with pending_deaths_lock:
+                flushed_death_totals.clear()
+            logger.info("Death counts decayed in database")
         except IntegrityError as e:
-            print(f"Database integrity error during death count decay: {e}")
+            logger.error("Database integrity error during death count decay: %s", e)
             db.rollback()
         except Exception as e:
-            print(f"Error during death count decay: {e}")
+            logger.error("Error during death count decay: %s", e)
             db.rollback()
             raise
 
 
 # --- API ENDPOINTS ---
 
+# Read queries are built once as lambda statements so their SQL is compiled and cached
+# on first use rather than reconstructed on every request
+dread_level_stmt = lambda_stmt(
+    lambda: select(DreadLevel.level).where(DreadLevel.area_id == bindparam("area_id"))
+)
+death_count_stmt = lambda_stmt(
+    lambda: select(AreaDeathCount.death_count).where(AreaDeathCount.area_id == bindparam("area_id"))
+)
+elevated_dread_areas_stmt = lambda_stmt(
+    lambda: select(DreadLevel.area_id, DreadLevel.level)
+    .where(DreadLevel.level > 0)
+    .order_by(DreadLevel.level.desc(), DreadLevel.id)
+)
+
+
+def load_death_total(area_id):
+    with get_db() as db:
+        return db.execute(death_count_stmt, {"area_id": area_id}).scalar_one_or_none() or 0
+
+
 @app.route('/api/log_death', methods=['POST'])
 @require_api_key  # Protect this route
 def log_death():
     data = request.get_json()
-    area_id = data.get('area_id')
+    area_id = data.get('area_id') if isinstance(data, dict) else None
     if not area_id:
-        return jsonify({"error": "area_id is required"}), 400
+        return json_response({"error": "area_id is required"}, 400)
+    # Reject ids the area_death_counts column can't store here, since a bad id would
+    # otherwise only fail later inside the shared batched write
+    if not isinstance(area_id, str) or len(area_id) > AREA_ID_MAX_LENGTH:
+        return json_response(
+            {"error": f"area_id must be a string of at most {AREA_ID_MAX_LENGTH} characters"}, 400
+        )
 
-    with get_db() as db:
-        try:
-            death_count = db.query(AreaDeathCount).filter_by(area_id=area_id).first()
-            if death_count:
-                death_count.death_count += 1
-                death_count.last_updated = datetime.utcnow()
-            else:
-                death_count = AreaDeathCount(area_id=area_id, death_count=1)
-                db.add(death_count)
+    # Deaths are buffered and written in batches by the flusher thread; the returned
+    # total is the last known stored count plus whatever is still pending for this area.
+    with pending_deaths_lock:
+        stored_total = get_death_total(area_id)
+    # Area not seen recently in this process: read its stored total from the database
+    loaded_total = load_death_total(area_id) if stored_total is None else None
 
-            db.commit()
-            current_deaths = death_count.death_count  
-            client_name = VALID_API_KEYS.get(request.headers.get('X-API-KEY'), "Unknown Client")
-            print(
-                f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Death logged in: {area_id}. "
-                f"Total deaths: {current_deaths} by {client_name}"
-            )
-            return jsonify({"message": f"Death logged for {area_id}", "current_deaths_in_area": current_deaths}), 200
-        except IntegrityError as e:
-            db.rollback()
-            print(f"Database integrity error logging death: {e}")
-            return jsonify({"error": "Database error: Could not log death due to data conflict."}), 500
-        except Exception as e:
-            db.rollback()
-            print(f"Error logging death: {e}")
-            return jsonify({"error": "An unexpected error occurred."}), 500
+    with pending_deaths_lock:
+        pending_deaths[area_id] += 1
+        if stored_total is None:
+            # Keep the flusher's value if it wrote this area while we were reading
+            stored_total = get_death_total(area_id)
+            if stored_total is None:
+                stored_total = loaded_total
+                store_death_total(area_id, loaded_total)
+        current_deaths = stored_total + pending_deaths[area_id]
+
+    logger.info("Death logged in: %s. Total deaths: %s by %s", area_id, current_deaths, g.client_name)
+    return json_response({"message": f"Death logged for {area_id}", "current_deaths_in_area": current_deaths}, 200)
 
 
 @app.route('/api/get_dread_level', methods=['GET'])
 def get_dread_level():
     area_id = request.args.get('area_id')
     if not area_id:
-        return jsonify({"error": "area_id is required"}), 400
+        return json_response({"error": "area_id is required"}, 400)
 
-    with get_db() as db:
-        dread_level_obj = db.query(DreadLevel).filter_by(area_id=area_id).first()
-        level = dread_level_obj.level if dread_level_obj else 0
+    cached = get_cached_dread(('area', area_id))
+    if cached:
+        result, body, etag = cached
+    else:
+        version = dread_version
+        with get_db() as db:
+            level = db.execute(dread_level_stmt, {"area_id": area_id}).scalar_one_or_none() or 0
+        result = {"area_id": area_id, "dread_level": level}
+        body, etag = cache_dread(('area', area_id), result, version)
 
-    print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Specific dread level requested for {area_id}. Sending: {level}")
-    return jsonify({"area_id": area_id, "dread_level": level}), 200
+    logger.info("Specific dread level requested for %s. Sending: %s", area_id, result['dread_level'])
+    return dread_response(body, etag)
 
 
 @app.route('/api/get_elevated_dread_areas', methods=['GET'])
 
 def get_elevated_dread_areas():
-    with get_db() as db:
-        elevated_areas_query = db.query(DreadLevel).filter(DreadLevel.level > 0).all()
-
-    result = [
-        {"area_id": area.area_id, "dread_level": area.level}
-        for area in sorted(elevated_areas_query, key=lambda x: x.level, reverse=True)
-    ]
+    cached = get_cached_dread(('elevated',))
+    if cached:
+        result, body, etag = cached
+    else:
+        version = dread_version
+        with get_db() as db:
+            elevated_areas = db.execute(elevated_dread_areas_stmt)
+            result = [{"area_id": area_id, "dread_level": level} for area_id, level in elevated_areas]
+        body, etag = cache_dread(('elevated',), result, version)
 
-    print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Elevated dread areas requested. Sending: {result}")
-    return jsonify(result), 200
+    logger.info("Elevated dread areas requested. Sending: %s", result)
+    return dread_response(body, etag)
 
 
 """ # --- Notes System ---
@@ -276,9 +560,9 @@ def leave_note():
     word = data.get('word')
 
     if not all([area_id, note_location_id, word]):
-        return jsonify({"error": "area_id, note_location_id, and word are required"}), 400
+        return json_response({"error": "area_id, note_location_id, and word are required"}, 400)
     if word not in PRE_DEFINED_WORDS:
-        return jsonify({"error": f"Invalid word. Choose from: {PRE_DEFINED_WORDS}"}), 400
+        return json_response({"error": f"Invalid word. Choose from: {PRE_DEFINED_WORDS}"}, 400)
 
     with get_db() as db:
         try:
@@ -291,21 +575,17 @@ def leave_note():
             db.add(note)  # add will become a merge/replace due to the constraint
             db.commit()
 
-            client_name = VALID_API_KEYS.get(request.headers.get('X-API-KEY'), "Unknown Client")
             # Log client name (description from .env, not the key itself)
-            print(
-                f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Note left/updated at "
-                f"{area_id}_{note_location_id}: {word} by {client_name}"
-            )
-            return jsonify({"message": "Note left/updated successfully"}), 200
+            logger.info("Note left/updated at %s_%s: %s by %s", area_id, note_location_id, word, g.client_name)
+            return json_response({"message": "Note left/updated successfully"}, 200)
         except IntegrityError as e:  # Should be less likely with REPLACE but good to have
             db.rollback()
-            print(f"Database integrity error leaving note: {e}")
-            return jsonify({"error": "Database error: Could not leave note due to data conflict."}), 500
+            logger.error("Database integrity error leaving note: %s", e)
+            return json_response({"error": "Database error: Could not leave note due to data conflict."}, 500)
         except Exception as e:
             db.rollback()
-            print(f"Error leaving note: {e}")
-            return jsonify({"error": "An unexpected error occurred."}), 500
+            logger.error("Error leaving note: %s", e)
+            return json_response({"error": "An unexpected error occurred."}, 500)
 
 
 @app.route('/api/get_player_notes', methods=['GET'])
@@ -313,64 +593,41 @@ def leave_note():
 def get_player_notes():
     area_id = request.args.get('area_id')
     if not area_id:
-        return jsonify({"error": "area_id is required"}), 400
+        return json_response({"error": "area_id is required"}, 400)
 
     with get_db() as db:
         notes_query = db.query(PlayerNote).filter_by(area_id=area_id).all()
     result = [{"location_id": note.note_location_id, "word": note.word} for note in notes_query]
 
-    return jsonify(result), 200 """
+    return json_response(result, 200) """
 
 
 # --- PERIODIC TASK SCHEDULER ---
-def run_periodic_tasks():  # noqa: C901
-    print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Starting periodic task scheduler...")
-    try:
-        calculate_and_assign_dread_levels()
-    except Exception as e:
-        print(f"Error in initial dread calculation: {e}")
-    try:
-        decay_death_counts() 
-    except Exception as e:
-        print(f"Error in initial death count decay: {e}")
-
-    last_decay_time = time.time()
-    last_dread_calc_time = time.time()
-
-    while True:
-        # Use a short sleep to prevent tight looping if an error occurs immediately
-        time.sleep(5)
-
-        current_time_for_checks = time.time()
+def run_periodic_tasks():
+    # Both jobs also run once immediately; the scheduler runs them on its own threads
+    logger.info("Starting periodic task scheduler...")
+    scheduler = BackgroundScheduler()
+    scheduler.add_job(
+        calculate_and_assign_dread_levels, 'interval', seconds=DREAD_CALCULATION_INTERVAL_SECONDS,
+        next_run_time=datetime.now(), max_instances=1, coalesce=True
+    )
+    scheduler.add_job(
+        decay_death_counts, 'interval', seconds=DECAY_INTERVAL_SECONDS,
+        next_run_time=datetime.now(), max_instances=1, coalesce=True
+    )
+    scheduler.start()
+    return scheduler
 
-        try:
-            if current_time_for_checks - last_decay_time >= DECAY_INTERVAL_SECONDS:
-                print(
-                    f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Triggering decay_death_counts and "
-                    f"calculate_and_assign_dread_levels due to decay interval..."
-                )
-                decay_death_counts()
-                calculate_and_assign_dread_levels()
-                last_decay_time = time.time()
-                last_dread_calc_time = last_decay_time
-            elif current_time_for_checks - last_dread_calc_time >= DREAD_CALCULATION_INTERVAL_SECONDS:
-                print(
-                    f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Triggering calculate_and_assign_dread_levels "
-                    f"due to dread calculation interval..."
-                )
-                calculate_and_assign_dread_levels()
-                last_dread_calc_time = time.time()
-        except Exception as e:
-            print(
-                f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] EXCEPTION in periodic task loop: {e}. "
-                f"Attempting to continue..."
-            )
 
 if __name__ == '__main__':
-    print("Ensuring database and tables are created if they don't exist...")
+    logger.info("Ensuring database and tables are created if they don't exist...")
     create_db_and_tables()
 
-    scheduler_thread = threading.Thread(target=run_periodic_tasks, daemon=True)
-    scheduler_thread.start()
-    print("Starting Flask server with periodic dread calculation task on host 0.0.0.0, port from FLASK_RUN_PORT or default 5001...")
+    run_periodic_tasks()
+    death_flusher_thread = threading.Thread(target=run_death_flusher, daemon=True)
+    death_flusher_thread.start()
+    logger.info(
+        "Starting Flask server with periodic dread calculation task on host 0.0.0.0, "
+        "port from FLASK_RUN_PORT or default 5001..."
+    )
     app.run(debug=False, host='0.0.0.0', port=int(os.environ.get("FLASK_RUN_PORT", 5001)))
@@ -1,19 +1,113 @@
+import os
+import shutil
+import tempfile
+import threading
+from collections import Counter, OrderedDict
 import pytest
-from server import app
+
+# Point the app at a throwaway SQLite file before it is imported so tests never touch dread_system.db
+os.environ['DB_CONNECTION_TYPE'] = 'SQLITE'
+TEST_DB_DIR = tempfile.mkdtemp()
+os.environ['SQLITE_DB_PATH'] = os.path.join(TEST_DB_DIR, 'test_dread_system.db')
+
+from server import app  # noqa: E402
+from models import create_db_and_tables, engine  # noqa: E402
+
+
+@pytest.fixture(scope='session', autouse=True)
+def test_db_dir():
+    yield TEST_DB_DIR
+    engine.dispose()
+    shutil.rmtree(TEST_DB_DIR, ignore_errors=True)
 
 
 @pytest.fixture
 def client():
     app.config['TESTING'] = True
-    # Todo: Mock DB interactions.
-    # For this basic test, we'll assume an empty DB or that the endpoint handles it gracefully.
+    create_db_and_tables()
+    # Tables live in the session's temporary SQLite file; tests use their own area ids
     with app.test_client() as client:
         yield client
 
 
+@pytest.fixture
+def authed_server(monkeypatch):
+    """Configure a single test API key and reset rate limiting and death batching state."""
+    import server
+    monkeypatch.setattr(server, 'VALID_API_KEYS', {'test_key': 'TestClient'})
+    monkeypatch.setattr(server, 'VALID_API_KEY_ITEMS', ((b'test_key', 'TestClient'),))
+    monkeypatch.setattr(
+        server, 'request_attempts_shards',
+        [(threading.Lock(), {}) for _ in range(server.RATE_LIMIT_SHARDS)]
+    )
+    monkeypatch.setattr(server, 'pending_deaths', Counter())
+    monkeypatch.setattr(server, 'flushed_death_totals', OrderedDict())
+    return server
+
+
 def test_get_elevated_dread_areas_unauthenticated(client):
     """Test the /api/get_elevated_dread_areas endpoint returns 200 OK."""
     response = client.get('/api/get_elevated_dread_areas')
     assert response.status_code == 200
     assert response.is_json
     # For now, just checking it loads and is JSON.
+
+
+def test_rate_limit_rejects_after_max_attempts(client, authed_server):
+    """Test that an IP is rate limited once it exceeds RATE_LIMIT_ATTEMPTS in the window."""
+    server = authed_server
+
+    for _ in range(server.RATE_LIMIT_ATTEMPTS):
+        response = client.post('/api/log_death', json={'area_id': 'test_area'}, headers={'X-API-KEY': 'wrong'})
+        assert response.status_code == 401
+
+    response = client.post('/api/log_death', json={'area_id': 'test_area'}, headers={'X-API-KEY': 'wrong'})
+    assert response.status_code == 429
+
+
+def test_get_elevated_dread_areas_not_modified(client):
+    """Test that a matching If-None-Match on /api/get_elevated_dread_areas returns 304 Not Modified."""
+    response = client.get('/api/get_elevated_dread_areas')
+    etag = response.headers.get('ETag')
+    assert etag
+
+    response = client.get('/api/get_elevated_dread_areas', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+
+
+def test_log_death_batches_deaths_until_flushed(client, authed_server, monkeypatch):
+    """Test that /api/log_death buffers deaths and flush_pending_deaths writes them as per-area totals."""
+    server = authed_server
+    from models import SessionLocal, AreaDeathCount
+
+    def log_death(area_id):
+        response = client.post('/api/log_death', json={'area_id': area_id}, headers={'X-API-KEY': 'test_key'})
+        assert response.status_code == 200
+        return response.get_json()['current_deaths_in_area']
+
+    assert [log_death('batch_area_a') for _ in range(3)] == [1, 2, 3]
+    assert [log_death('batch_area_b') for _ in range(2)] == [1, 2]
+
+    server.flush_pending_deaths()
+    assert not server.pending_deaths
+
+    with SessionLocal() as db:
+        rows = dict(
+            db.query(AreaDeathCount.area_id, AreaDeathCount.death_count)
+            .filter(AreaDeathCount.area_id.in_(['batch_area_a', 'batch_area_b']))
+            .all()
+        )
+    assert rows == {'batch_area_a': 3, 'batch_area_b': 2}
+
+    # A fresh process (or another gunicorn worker) seeds the area's total from the database
+    monkeypatch.setattr(server, 'flushed_death_totals', OrderedDict())
+    assert log_death('batch_area_a') == 4
+
+    def failing_write(deltas):
+        raise RuntimeError("database unavailable")
+
+    monkeypatch.setattr(server, 'write_death_deltas', failing_write)
+    log_death('batch_area_b')
+    server.flush_pending_deaths()
+    assert server.pending_deaths == Counter({'batch_area_a': 1, 'batch_area_b': 1})